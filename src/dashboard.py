@@ -14,8 +14,17 @@ import pandas as pd
 import seaborn as sns
 import numpy as np
 import os
+import re
 import plotly.graph_objects as go
 import matplotlib.dates as mdates
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from flask import Response, request
+from src.export import EXPORT_VARIABLES, check_variables, iter_export_bytes, parse_lead_hours, parse_points
+from src.region import parse_bounds
+from src.harmonie_file_handler import get_latest_forecast
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,13 +44,35 @@ NETCDF_PATH = os.getenv('NETCDF_PATH', None)
 if NETCDF_PATH is None:
     raise RuntimeError("Environment variable NETCDF_PATH must be set to the path of the netCDF file.")
 
+# Locations precomputed after every forecast load, as "lat,lon;lat,lon;..."
+# Defaults to the largest Dutch cities
+HOT_LOCATIONS = [
+    tuple(float(x) for x in location.split(','))
+    for location in os.getenv(
+        'HOT_LOCATIONS',
+        '52.3676,4.9041;51.9244,4.4777;52.0705,4.3007;52.0907,5.1214;51.4416,5.4697;53.2194,6.5665'
+    ).split(';') if location
+]
+# Number of most clicked grid cells that are precomputed in addition to HOT_LOCATIONS
+LEARNED_HOT_LOCATIONS = int(os.getenv('LEARNED_HOT_LOCATIONS', '10'))
+# Seconds between checks for a newly processed forecast
+RELOAD_INTERVAL = int(os.getenv('RELOAD_INTERVAL', '60'))
+# Maximum number of grid cells whose figures are kept in memory
+FIGURE_CACHE_SIZE = int(os.getenv('FIGURE_CACHE_SIZE', '256'))
+
 GLOBAL_DS = None
-def load_initial_data():    
+GLOBAL_VERSION = 0
+DATASET_LOCK = threading.Lock()
+FIGURE_CACHE = OrderedDict()
+# Clicks per grid cell not yet written to the database
+CLICK_COUNTS = Counter()
+
+def load_initial_data(path=NETCDF_PATH):    
     try:
         logger.info("Attempting to load netCDF file...")
-        if NETCDF_PATH is None:
+        if path is None:
             raise ValueError("NETCDF_PATH is None. Cannot load dataset.")
-        ds = xr.open_dataset(NETCDF_PATH)
+        ds = xr.open_dataset(path)
         logger.info("Successfully loaded netCDF file")
         return ds
     except Exception as e:
@@ -51,8 +82,8 @@ def load_initial_data():
 GLOBAL_DS = load_initial_data()
 
   
-def compute_rolling_difference(df, variable='prec'):
-    return df.groupby(['run_number'])[variable].diff()
+def compute_rolling_difference(df, variable='prec', periods=1):
+    return df.groupby(['run_number'])[variable].diff(periods)
 
 
 
@@ -64,13 +95,35 @@ def get_location_data(ds, lat, lon):
         return pd.DataFrame(), pd.DataFrame()
     
     # Select nearest point to given coordinates
-    location_data = ds.sortby('run_number').sel(lat=lat, lon=lon,method='nearest').to_dataframe()
-    location_data['prec_diff'] = compute_rolling_difference(location_data, 'prec')
+    location_data = ds[['temp', 'prec']].sortby('run_number').sel(lat=lat, lon=lon,method='nearest').to_dataframe()
     logger.info("Successfully retrieved location data")   
     
     return location_data
 
 
+def get_accumulation_windows(ds):
+    """Get the accumulation windows in hours stored in the dataset.
+
+    Forecasts processed before accumulation windows were stored only offer hourly differences.
+    """
+    if ds is None:
+        return [1]
+    windows = sorted(int(match.group(1)) for name in ds.data_vars
+                     if (match := re.fullmatch(r'prec_(\d+)h_pct', name)))
+    return windows or [1]
+
+
+def get_accumulation_percentiles(ds, lat, lon, window):
+    """Get the stored ensemble percentiles of precipitation accumulated over `window` hours.
+
+    Returns None for forecasts processed before accumulation windows were stored.
+    """
+    name = f'prec_{window}h_pct'
+    if name not in ds:
+        return None
+    return ds[name].sel(lat=lat, lon=lon, method='nearest').transpose('valid_time', 'percentile').to_pandas()
+
+
 def create_map():
     return dl.Map([
         dl.TileLayer()
@@ -85,19 +138,32 @@ def create_map():
         # clickData={'lat': UTRECHT_LAT, 'lon': UTRECHT_LON}
     )
 
-app.layout = html.Div([
-    # Leaflet map component
-    create_map(),
-    
-    # Store clicked location data (lat, lon)
-    dcc.Store(id='clicked-location'),  
-    
-    # Graph for temperature data
-    dcc.Graph(id='temperature-graph'),
-    
-    # Graph for precipitation data
-    dcc.Graph(id='precipitation-graph')
-], style={'padding': '20px'})  # Added padding of 20px around all content
+def serve_layout():
+    windows = get_accumulation_windows(GLOBAL_DS)
+    return html.Div([
+        # Leaflet map component
+        create_map(),
+
+        # Store clicked location data (lat, lon)
+        dcc.Store(id='clicked-location'),
+
+        # Graph for temperature data
+        dcc.Graph(id='temperature-graph'),
+
+        # Precipitation accumulation windows of the loaded forecast
+        dcc.RadioItems(
+            id='accumulation-window',
+            options=[{'label': f'{window} hour', 'value': window} for window in windows],
+            value=windows[0],
+            inline=True
+        ),
+
+        # Graph for precipitation data
+        dcc.Graph(id='precipitation-graph')
+    ], style={'padding': '20px'})  # Added padding of 20px around all content
+
+# Evaluated on every page load, so the window options follow the loaded forecast
+app.layout = serve_layout
 
 # Callback to capture click location and store it
 @app.callback(
@@ -114,7 +180,7 @@ def store_click_location(n_clicks, clickData):
         return {'lat': lat, 'lon': lon}
     return None
 
-def create_percentile_plot(data_series, ylabel ='', title='Time Series Percentile Distribution'):
+def create_percentile_plot(data_series, ylabel ='', title='Time Series Percentile Distribution', precomputed=False):
     """
     Create a percentile plot from a time series data.
     
@@ -124,6 +190,8 @@ def create_percentile_plot(data_series, ylabel ='', title='Time Series Percentil
         Time series data to plot, should be unstacked with time index and multiple columns
     title : str
         Title for the plot (default: 'Time Series Percentile Distribution')
+    precomputed : bool
+        Whether the columns of data_series already are the 5, 25, 50, 75 and 95th percentiles
         
     Returns:
     --------
@@ -131,7 +199,10 @@ def create_percentile_plot(data_series, ylabel ='', title='Time Series Percentil
         The created figure object
     """
     # Calculate percentiles    
-    percentiles = np.nanpercentile(data_series, q=[5, 25, 50, 75, 95], axis=1)
+    if precomputed:
+        percentiles = data_series.to_numpy().T
+    else:
+        percentiles = np.nanpercentile(data_series, q=[5, 25, 50, 75, 95], axis=1)
     time_steps = data_series.index
 
     name = title
@@ -195,25 +266,173 @@ def create_percentile_plot(data_series, ylabel ='', title='Time Series Percentil
     
     return fig
 
+def nearest_cell(ds, lat, lon):
+    """Snap coordinates to the center of the nearest grid cell of the dataset."""
+    lat_idx = ds.indexes['lat'].get_indexer([lat], method='nearest')[0]
+    lon_idx = ds.indexes['lon'].get_indexer([lon], method='nearest')[0]
+    return float(ds['lat'][lat_idx]), float(ds['lon'][lon_idx])
+
+
+def get_cached_figures(lat, lon, window=None):
+    """Get the figures of the grid cell nearest to the coordinates, computing them on a cache miss.
+
+    Each cached cell holds its temperature figure and one precipitation figure per window.
+    """
+    with DATASET_LOCK:
+        ds, version = GLOBAL_DS, GLOBAL_VERSION
+    if ds is None:
+        return go.Figure(), go.Figure()
+
+    windows = get_accumulation_windows(ds)
+    if window not in windows:
+        window = windows[0]
+
+    key = (version, *nearest_cell(ds, lat, lon))
+    with DATASET_LOCK:
+        figures = dict(FIGURE_CACHE.get(key, {}))
+        if key in FIGURE_CACHE:
+            FIGURE_CACHE.move_to_end(key)
+
+    if 'temp' not in figures:
+        figures['temp'] = create_temperature_figure(ds, key[1], key[2])
+    if window not in figures:
+        figures[window] = create_precipitation_figure(ds, key[1], key[2], window)
+
+    with DATASET_LOCK:
+        # Skip caching when a newer forecast was loaded while computing
+        if version == GLOBAL_VERSION:
+            FIGURE_CACHE.setdefault(key, {}).update(figures)
+            FIGURE_CACHE.move_to_end(key)
+            while len(FIGURE_CACHE) > FIGURE_CACHE_SIZE:
+                FIGURE_CACHE.popitem(last=False)
+    return figures['temp'], figures[window]
+
+
+def get_tracker_db():
+    """Connect to the tracker database next to NETCDF_PATH."""
+    return sqlite3.connect(Path(NETCDF_PATH).parent / 'netcdf_tracker.db')
+
+
+def record_click(lat, lon):
+    """Count a click on a grid cell in memory, written to the database by flush_clicks."""
+    with DATASET_LOCK:
+        CLICK_COUNTS[(lat, lon)] += 1
+
+
+def flush_clicks():
+    """Add the clicks counted since the last flush to the database, so learned hot locations survive restarts."""
+    global CLICK_COUNTS
+    with DATASET_LOCK:
+        counts, CLICK_COUNTS = CLICK_COUNTS, Counter()
+    if not counts:
+        return
+
+    conn = get_tracker_db()
+    try:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS location_clicks "
+                  "(lat REAL, lon REAL, clicks INTEGER, PRIMARY KEY (lat, lon))")
+        c.executemany("INSERT INTO location_clicks VALUES (?, ?, ?) "
+                      "ON CONFLICT (lat, lon) DO UPDATE SET clicks = clicks + excluded.clicks",
+                      [(lat, lon, clicks) for (lat, lon), clicks in counts.items()])
+        conn.commit()
+    except sqlite3.Error:
+        # Keep the counts for the next flush
+        with DATASET_LOCK:
+            CLICK_COUNTS.update(counts)
+        raise
+    finally:
+        conn.close()
+
+
+def get_most_clicked(limit):
+    """Get the most clicked grid cells as (lat, lon)."""
+    conn = get_tracker_db()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT lat, lon FROM location_clicks ORDER BY clicks DESC LIMIT ?", (limit,))
+        return [tuple(row) for row in c.fetchall()]
+    except sqlite3.OperationalError:
+        # No clicks recorded yet
+        return []
+    finally:
+        conn.close()
+
+
+def warm_cache():
+    """Precompute figures of the configured and most clicked locations."""
+    learned = get_most_clicked(LEARNED_HOT_LOCATIONS) if LEARNED_HOT_LOCATIONS > 0 else []
+    locations = list(dict.fromkeys(HOT_LOCATIONS + learned))
+
+    with DATASET_LOCK:
+        windows = get_accumulation_windows(GLOBAL_DS)
+
+    start = time.perf_counter()
+    for lat, lon in locations:
+        try:
+            for window in windows:
+                get_cached_figures(lat, lon, window)
+        except Exception as e:
+            logger.error(f"Error warming cache for lat={lat}, lon={lon}: {e}")
+    logger.info(f"Warmed cache for {len(locations)} locations in {time.perf_counter() - start:.1f}s")
+
+
+def watch_for_new_forecast():
+    """Swap in newly processed forecasts and warm the cache for each of them."""
+    global GLOBAL_DS, GLOBAL_VERSION
+    current_path = NETCDF_PATH
+    warm_cache()
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            flush_clicks()
+        except sqlite3.Error as e:
+            logger.error(f"Error recording clicks: {e}")
+        try:
+            latest_path = get_latest_forecast(Path(NETCDF_PATH).parent)
+        except sqlite3.Error as e:
+            logger.error(f"Error checking for new forecast: {e}")
+            continue
+        if latest_path is None or str(latest_path) == current_path:
+            continue
+        latest_path = str(latest_path)
+
+        ds = load_initial_data(latest_path)
+        if ds is None:
+            continue
+        logger.info(f"Loaded new forecast {latest_path}")
+        with DATASET_LOCK:
+            GLOBAL_DS = ds
+            GLOBAL_VERSION += 1
+            FIGURE_CACHE.clear()
+        current_path = latest_path
+        warm_cache()
+
+
 # Callback to update graphs based on clicked location
 @app.callback(
     [Output('temperature-graph', 'figure'),
      Output('precipitation-graph', 'figure')],
-    Input('clicked-location', 'data')  # Triggered when the clicked-location is updated
+    [Input('clicked-location', 'data'),  # Triggered when the clicked-location is updated
+     Input('accumulation-window', 'value')]
 )
 
-def update_graphs(location):
+def update_graphs(location, window):
     if location is None:
         return go.Figure(), go.Figure()  # Return empty figures if no location clicked    
-    
-    # Dummy data for the temperature and precipitation graphs
-    # In a real-world scenario, you would query an API or use real data based on lat/lon
-    
-    # Load data once at startup
+
     lat, lon = location['lat'], location['lon']   
-    
-    
-    location_data = get_location_data(GLOBAL_DS, lat, lon)    
+    with DATASET_LOCK:
+        ds = GLOBAL_DS
+    if ds is not None and dash.ctx.triggered_id == 'clicked-location':
+        record_click(*nearest_cell(ds, lat, lon))
+
+    return get_cached_figures(lat, lon, window)
+
+
+def create_temperature_figure(ds, lat, lon):
+    """Create the temperature figure for a location."""
+    location_data = get_location_data(ds, lat, lon)    
 
     # Temperature graph
     data_temp= location_data['temp'].unstack('run_number') # type: ignore
@@ -222,11 +441,20 @@ def update_graphs(location):
     y_min = np.floor(y_values.min() / 10) * 10
     y_max = np.ceil(y_values.max()/ 10) * 10
     temperature_figure.update_layout(yaxis_range=[y_min, y_max])
-    
-    # Precipitation graph
-    data_temp = location_data['prec_diff'].unstack('run_number')
-    precipitation_figure = create_percentile_plot(data_temp, ylabel='Precipitation [mm]', title='Precipitation Forecast')
-    y_max = data_temp.max().max()
+
+    return temperature_figure
+
+
+def create_precipitation_figure(ds, lat, lon, window):
+    """Create the figure of precipitation accumulated over `window` hours for a location."""
+    data_prec = get_accumulation_percentiles(ds, lat, lon, window)
+    if data_prec is not None:
+        precipitation_figure = create_percentile_plot(data_prec, ylabel=f'Precipitation [mm/{window}h]', title='Precipitation Forecast', precomputed=True)
+    else:
+        location_data = get_location_data(ds, lat, lon)
+        data_prec = compute_rolling_difference(location_data, 'prec', periods=window).unstack('run_number')
+        precipitation_figure = create_percentile_plot(data_prec, ylabel=f'Precipitation [mm/{window}h]', title='Precipitation Forecast')
+    y_max = data_prec.max().max()
     if y_max < 2.5:
         y_limit = 2.5
         label = "Light"
@@ -249,10 +477,47 @@ def update_graphs(location):
         ]
     )
 
-    return temperature_figure, precipitation_figure
+    return precipitation_figure
+
+
+
+# Bulk export of ensemble series, e.g. /export?format=parquet&variables=temp&bbox=51,4,53,6&lead_hours=0-24
+@app.server.route('/export')
+def export_series():
+    with DATASET_LOCK:
+        ds = GLOBAL_DS
+    if ds is None:
+        return Response("No forecast loaded", status=503)
+
+    args = request.args
+    export_format = args.get('format', 'arrow')
+    if export_format not in ('arrow', 'parquet'):
+        return Response(f"Unknown export format {export_format}", status=400)
+    try:
+        variables = args.get('variables', ','.join(EXPORT_VARIABLES)).split(',')
+        bounds = parse_bounds(args['bbox']) if 'bbox' in args else None
+        points = parse_points(args['points']) if 'points' in args else None
+        lead_hours = parse_lead_hours(args['lead_hours']) if 'lead_hours' in args else None
+        check_variables(ds, variables)
+    except ValueError as e:
+        return Response(f"Invalid export parameters: {e}", status=400)
+
+    mimetype = 'application/vnd.apache.parquet' if export_format == 'parquet' else 'application/vnd.apache.arrow.stream'
+    chunks = iter_export_bytes(ds, export_format, variables=variables, bounds=bounds,
+                               points=points, lead_hours=lead_hours)
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=export.{export_format}'
+    })
+
 
+def start_forecast_watcher():
+    """Warm the cache in the background and keep it up to date with new forecasts."""
+    thread = threading.Thread(target=watch_for_new_forecast, name='forecast-watcher', daemon=True)
+    thread.start()
+    return thread
 
 
 # Run the app
 if __name__ == '__main__':
+    start_forecast_watcher()
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,307 @@
+"""Bulk export of ensemble series as Apache Arrow record batches or Parquet files.
+
+Values are read block by block straight from the forecast arrays, so memory use is
+bounded by the block size rather than by the size of the extract.
+"""
+import argparse
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xarray as xr
+
+from src.logger_config import get_logger, setup_logging
+from src.region import Bounds, parse_bounds
+
+logger = get_logger(__name__)
+
+EXPORT_VARIABLES = ('temp', 'prec')
+
+# Dimensions of the per-member fields that can be exported
+MEMBER_DIMS = ('valid_time', 'run_number', 'lat', 'lon')
+
+# Number of grid cells read per record batch, roughly a million rows for a full forecast
+CELLS_PER_BATCH = 512
+
+def parse_lead_hours(value: str) -> List[int]:
+    """Parse lead hours given as e.g. "0-24,36,48"."""
+    hours = []
+    for part in value.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            hours.extend(range(int(start), int(end) + 1))
+        elif part:
+            hours.append(int(part))
+    return hours
+
+
+def parse_points(value: str) -> List[Tuple[float, float]]:
+    """Parse locations given as "lat,lon;lat,lon"."""
+    points = []
+    for point in value.split(';'):
+        if not point:
+            continue
+        coords = tuple(float(x) for x in point.split(','))
+        if len(coords) != 2:
+            raise ValueError(f"Expected a location as lat,lon, got {point}")
+        points.append(coords)
+    return points
+
+
+def check_variables(ds: xr.Dataset, variables: Sequence[str]) -> None:
+    """Raise a ValueError unless all variables are per-member fields that can be exported."""
+    invalid = [name for name in variables
+               if name not in ds.data_vars or set(ds[name].dims) != set(MEMBER_DIMS)]
+    if invalid:
+        raise ValueError(f"Variables {invalid} cannot be exported, expected dimensions {MEMBER_DIMS}")
+
+
+def lead_time_hours(ds: xr.Dataset) -> np.ndarray:
+    """Hours between the issue time of the forecast and each valid time."""
+    valid_time = ds['valid_time'].values
+    issue_time = ds['issue_time'].values if 'issue_time' in ds.coords else valid_time.min()
+    return ((valid_time - issue_time) / np.timedelta64(1, 'h')).astype(np.int32)
+
+
+def export_schema(ds: xr.Dataset, variables: Sequence[str]) -> pa.Schema:
+    """Schema of the exported record batches, one row per cell, valid time and member."""
+    return pa.schema(
+        [
+            ('lat', pa.float32()),
+            ('lon', pa.float32()),
+            ('valid_time', pa.timestamp('ns')),
+            ('lead_time', pa.int32()),
+            ('run_number', pa.int32()),
+        ]
+        + [(name, pa.from_numpy_dtype(ds[name].dtype)) for name in variables]
+    )
+
+
+def _spatial_chunk_sizes(ds: xr.Dataset, variables: Sequence[str]) -> Tuple[int, int]:
+    """Number of (lat, lon) cells per chunk on disk, (1, 1) if the variables are not chunked."""
+    for name in variables:
+        chunks = ds[name].encoding.get('chunksizes')
+        if chunks:
+            dims = ds[name].dims
+            return chunks[dims.index('lat')], chunks[dims.index('lon')]
+    return 1, 1
+
+
+def _aligned_slices(start: int, stop: int, size: int) -> Iterator[slice]:
+    """Split start:stop into slices whose boundaries fall on multiples of size."""
+    while start < stop:
+        end = min((start // size + 1) * size, stop)
+        yield slice(start, end)
+        start = end
+
+
+def _cell_blocks(ds: xr.Dataset, bounds: Optional[Bounds], points: Optional[Sequence[Tuple[float, float]]],
+                 cells_per_batch: int, chunks: Tuple[int, int] = (1, 1)) -> Iterator[dict]:
+    """Yield indexers that each select a block of at most `cells_per_batch` grid cells.
+
+    Blocks of a bounding box are aligned to the chunks on disk, so every chunk is decompressed
+    only once. A block only exceeds `cells_per_batch` when a single chunk is larger than that.
+    """
+    if points is not None:
+        lats, lons = np.array(points, dtype=float).reshape(-1, 2).T
+        lat_idx = ds.indexes['lat'].get_indexer(lats, method='nearest')
+        lon_idx = ds.indexes['lon'].get_indexer(lons, method='nearest')
+        for start in range(0, len(lat_idx), cells_per_batch):
+            stop = start + cells_per_batch
+            yield {
+                'lat': xr.DataArray(lat_idx[start:stop], dims='cell'),
+                'lon': xr.DataArray(lon_idx[start:stop], dims='cell'),
+            }
+        return
+
+    lat = ds['lat'].values
+    lon = ds['lon'].values
+    lat_mask = np.ones(len(lat), dtype=bool)
+    lon_mask = np.ones(len(lon), dtype=bool)
+    if bounds is not None:
+        (south, west), (north, east) = bounds
+        lat_mask = (lat >= south) & (lat <= north)
+        lon_mask = (lon >= west) & (lon <= east)
+    lat_idx = np.flatnonzero(lat_mask)
+    lon_idx = np.flatnonzero(lon_mask)
+    if len(lat_idx) == 0 or len(lon_idx) == 0:
+        return
+
+    lat_chunk, lon_chunk = chunks
+    n_lon = lon_idx[-1] + 1 - lon_idx[0]
+    if lat_chunk * n_lon <= cells_per_batch:
+        # Whole rows of the bounding box, several bands of chunks at once
+        rows_per_batch = cells_per_batch // n_lon // lat_chunk * lat_chunk
+        cols_per_batch = n_lon
+    else:
+        # A single band of chunks is too large, so also split it along lon
+        rows_per_batch = lat_chunk
+        cols_per_batch = max(1, cells_per_batch // lat_chunk // lon_chunk) * lon_chunk
+
+    for lat_slice in _aligned_slices(lat_idx[0], lat_idx[-1] + 1, rows_per_batch):
+        if cols_per_batch == n_lon:
+            yield {'lat': lat_slice, 'lon': slice(lon_idx[0], lon_idx[-1] + 1)}
+            continue
+        for lon_slice in _aligned_slices(lon_idx[0], lon_idx[-1] + 1, cols_per_batch):
+            yield {'lat': lat_slice, 'lon': lon_slice}
+
+
+def iter_record_batches(ds: xr.Dataset, variables: Sequence[str] = EXPORT_VARIABLES,
+                        bounds: Optional[Bounds] = None,
+                        points: Optional[Sequence[Tuple[float, float]]] = None,
+                        lead_hours: Optional[Sequence[int]] = None,
+                        cells_per_batch: int = CELLS_PER_BATCH) -> Iterator[pa.RecordBatch]:
+    """
+    Stream ensemble series of the selected cells as Arrow record batches.
+
+    Parameters:
+    -----------
+    ds : xarray.Dataset
+        Forecast dataset with (valid_time, run_number, lat, lon) variables
+    variables : sequence of str
+        Variables to export
+    bounds : ((south, west), (north, east)), optional
+        Export all cells inside the bounding box, defaults to the full grid
+    points : sequence of (lat, lon), optional
+        Export the cells nearest to these locations instead of a bounding box
+    lead_hours : sequence of int, optional
+        Only export these lead times, defaults to all
+    cells_per_batch : int
+        Number of grid cells per record batch
+
+    Returns:
+    --------
+    iterator of pyarrow.RecordBatch
+    """
+    check_variables(ds, variables)
+    schema = export_schema(ds, variables)
+    lead_time = lead_time_hours(ds)
+    time_idx = np.arange(len(lead_time))
+    if lead_hours is not None:
+        time_idx = np.flatnonzero(np.isin(lead_time, lead_hours))
+
+    valid_time = ds['valid_time'].values[time_idx]
+    lead_time = lead_time[time_idx]
+    run_number = ds['run_number'].values.astype(np.int32)
+    n_time, n_run = len(time_idx), len(run_number)
+
+    chunks = _spatial_chunk_sizes(ds, variables)
+    for indexers in _cell_blocks(ds, bounds, points, cells_per_batch, chunks):
+        block = ds[list(variables)].isel(valid_time=time_idx, **indexers)
+        if 'cell' in block.dims:
+            block = block.transpose('cell', 'valid_time', 'run_number')
+            cell_lat = block['lat'].values
+            cell_lon = block['lon'].values
+        else:
+            block = block.transpose('lat', 'lon', 'valid_time', 'run_number')
+            cell_lat, cell_lon = np.meshgrid(block['lat'].values, block['lon'].values, indexing='ij')
+        n_cells = cell_lat.size
+
+        columns = [
+            np.repeat(cell_lat.ravel().astype(np.float32), n_time * n_run),
+            np.repeat(cell_lon.ravel().astype(np.float32), n_time * n_run),
+            np.tile(np.repeat(valid_time, n_run), n_cells),
+            np.tile(np.repeat(lead_time, n_run), n_cells),
+            np.tile(run_number, n_cells * n_time),
+        ] + [block[name].values.reshape(-1) for name in variables]
+
+        yield pa.RecordBatch.from_arrays([pa.array(column) for column in columns], schema=schema)
+
+
+class _ChunkSink:
+    """Write-only file object collecting the bytes written by an Arrow writer."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_export_bytes(ds: xr.Dataset, format: str = 'arrow', **kwargs) -> Iterator[bytes]:
+    """Stream the export as an Arrow IPC stream or Parquet file, one chunk per record batch."""
+    variables = kwargs.get('variables', EXPORT_VARIABLES)
+    check_variables(ds, variables)
+    schema = export_schema(ds, variables)
+    sink = _ChunkSink()
+    stream = pa.PythonFile(sink, mode='w')
+    if format == 'parquet':
+        writer = pq.ParquetWriter(stream, schema, compression='zstd')
+    elif format == 'arrow':
+        writer = pa.ipc.new_stream(stream, schema)
+    else:
+        raise ValueError(f"Unknown export format {format}")
+
+    with writer:
+        for batch in iter_record_batches(ds, **kwargs):
+            writer.write_batch(batch)
+            yield sink.pop()
+    yield sink.pop()
+
+
+def export_to_file(ds: xr.Dataset, path: Path, format: str = 'parquet', **kwargs) -> int:
+    """Write the export to a Parquet or Arrow IPC file and return the number of rows."""
+    variables = kwargs.get('variables', EXPORT_VARIABLES)
+    schema = export_schema(ds, variables)
+    if format == 'parquet':
+        writer = pq.ParquetWriter(str(path), schema, compression='zstd')
+    elif format == 'arrow':
+        writer = pa.ipc.new_file(str(path), schema)
+    else:
+        raise ValueError(f"Unknown export format {format}")
+
+    rows = 0
+    with writer:
+        for batch in iter_record_batches(ds, **kwargs):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export ensemble series as Arrow or Parquet.")
+    parser.add_argument('input', type=Path, help="Forecast NetCDF file")
+    parser.add_argument('output', type=Path, help="Output file")
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--variables', nargs='+', default=list(EXPORT_VARIABLES))
+    parser.add_argument('--bbox', type=parse_bounds, help="south,west,north,east")
+    parser.add_argument('--points', type=parse_points, help="lat,lon;lat,lon")
+    parser.add_argument('--lead-hours', type=parse_lead_hours, help="e.g. 0-24,36")
+    parser.add_argument('--cells-per-batch', type=int, default=CELLS_PER_BATCH)
+    args = parser.parse_args()
+
+    with xr.open_dataset(args.input) as ds:
+        try:
+            check_variables(ds, args.variables)
+        except ValueError as e:
+            parser.error(str(e))
+        rows = export_to_file(
+            ds, args.output, format=args.format, variables=args.variables, bounds=args.bbox,
+            points=args.points, lead_hours=args.lead_hours, cells_per_batch=args.cells_per_batch,
+        )
+    logger.info(f"Exported {rows} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
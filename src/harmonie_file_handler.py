@@ -1,24 +1,73 @@
 import pygrib
-from .logger_config import get_logger
+from .logger_config import get_logger, setup_logging
 
 from pathlib import Path
 import xarray as xr
+import pandas as pd
+import argparse
 import re
 from datetime import datetime, timedelta
 from tqdm import tqdm
 from src.file_tracker import FileTracker
+from src.region import Bounds, NL_BOUNDS
 from typing import Tuple, List, Optional
+import numpy as np
 import sqlite3
-import sqlite3
-import sqlite3
+
+# Block sizes of the coarsened pyramid levels written next to each forecast
+PYRAMID_FACTORS = (2, 4, 8)
+
+# Precipitation accumulation windows in hours, computed from the cumulative prec field
+ACCUMULATION_WINDOWS = (1, 3, 6, 24)
+
+# Ensemble percentiles stored for each accumulation window
+ACCUMULATION_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Spatial chunk size of the archived NetCDF variables
+ARCHIVE_TILE_SIZE = 32
+
+# Number of valid times per chunk of the archived NetCDF variables
+ARCHIVE_TIME_CHUNK = 1
+
+
+def level_path(path: Path, factor: int) -> Path:
+    """Return the path of the pyramid level coarsened by `factor` for a forecast file."""
+    return path.with_name(f"{path.stem}-coarse{factor}{path.suffix}")
+
+
+def get_latest_forecast(save_path: Path = Path('data')) -> Optional[Path]:
+    """Return the path of the most recent NetCDF forecast, or None if there is none yet."""
+    conn = sqlite3.connect(save_path / 'netcdf_tracker.db')
+    try:
+        c = conn.cursor()
+        c.execute("SELECT filename FROM netcdf_files WHERE removed = FALSE ORDER BY created_at DESC LIMIT 1")
+        latest_file = c.fetchone()
+    except sqlite3.OperationalError:
+        # The table is created by the first HarmonieFileHandler
+        latest_file = None
+    finally:
+        conn.close()
+    return save_path / latest_file[0] if latest_file else None
+
 
 class HarmonieFileHandler:
-    def __init__(self, save_path: Path = Path('data')):
+    def __init__(self, save_path: Path = Path('data'),
+                 bounds: Optional[Bounds] = NL_BOUNDS,
+                 pyramid_factors: Tuple[int, ...] = PYRAMID_FACTORS,
+                 retention_max_age: Optional[timedelta] = timedelta(hours=24),
+                 retention_max_bytes: Optional[int] = None,
+                 accumulation_windows: Tuple[int, ...] = ACCUMULATION_WINDOWS):
         self.parameter_mapping = {
             '11': 'temp',
             '181': 'prec'
         }
         self.save_path = save_path
+        self.bounds = bounds
+        self.pyramid_factors = pyramid_factors
+        self.retention_max_age = retention_max_age
+        self.retention_max_bytes = retention_max_bytes
+        self.accumulation_windows = accumulation_windows
+        self._crop_slices = None
         self.tracker = FileTracker()
         self.datasets = []
         self.logger = get_logger(__name__)
@@ -35,45 +84,98 @@ class HarmonieFileHandler:
         conn.close()
 
     def save_dataset(self, ds: xr.Dataset) -> None:
-        """Save dataset to NetCDF file and update database."""
-        filename = f"forecast-{datetime.now().strftime('%Y%m%d_%H%M')}.nc"
-        ds.to_netcdf(
-            self.save_path / filename,
-            encoding={
-                'temp': {'zlib': True, 'complevel': 5},
-                'prec': {'zlib': True, 'complevel': 5}
-            }
-        )
-        
+        """Append dataset and its pyramid levels to the forecast archive and update database."""
+        # Name runs after their issue time, so each run gets its own file
+        issue_time = pd.Timestamp(ds['issue_time'].values) if 'issue_time' in ds.coords else datetime.now()
+        filename = f"forecast-{issue_time.strftime('%Y%m%d_%H%M')}.nc"
+        ds.to_netcdf(self.save_path / filename, encoding=self.archive_encoding(ds))
+
+        for factor, level in self.build_pyramid(ds).items():
+            self.logger.info(f"Saving pyramid level coarsened by {factor}x")
+            level.to_netcdf(level_path(self.save_path / filename, factor), encoding=self.archive_encoding(level))
+
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
-        c.execute("INSERT INTO netcdf_files VALUES (?, ?, ?)", (filename, datetime.now(), False))
+        c.execute("INSERT OR REPLACE INTO netcdf_files VALUES (?, ?, ?)", (filename, datetime.now(), False))
         conn.commit()
         
-        # Delete old files
+        # Apply retention policy to older runs
         self.cleanup_old_files()
         conn.close()
 
+    def archive_encoding(self, ds: xr.Dataset) -> dict:
+        """Compressed encoding chunked in small spatial tiles per valid time.
+
+        A single cell at a single valid time then only needs one small chunk per run.
+        """
+        chunk_sizes = {'lat': ARCHIVE_TILE_SIZE, 'lon': ARCHIVE_TILE_SIZE, 'valid_time': ARCHIVE_TIME_CHUNK}
+        encoding = {}
+        for name, var in ds.data_vars.items():
+            chunks = [min(chunk_sizes.get(dim, size), size) for dim, size in zip(var.dims, var.shape)]
+            encoding[name] = {'zlib': True, 'complevel': 5, 'chunksizes': tuple(chunks)}
+        return encoding
+
     def cleanup_old_files(self):
-        """Delete all but the most recent NetCDF file."""
+        """Delete archived runs that fall outside the retention age or size limits.
+
+        The most recent run is always kept.
+        """
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
-        # Get all files except the most recent one
-        c.execute("SELECT filename FROM netcdf_files WHERE removed = FALSE ORDER BY created_at DESC")
+        c.execute("SELECT filename, created_at FROM netcdf_files WHERE removed = FALSE ORDER BY created_at DESC")
         files = c.fetchall()
-        
-        # Keep the most recent file, delete others
-        for filename, in files[1:]:
+
+        now = datetime.now()
+        total_bytes = 0
+        for i, (filename, created_at) in enumerate(files):
             file_path = self.save_path / filename
-            if file_path.exists():
-                file_path.unlink()
-                c.execute("UPDATE netcdf_files SET removed = TRUE WHERE filename = ?", (filename,))
+            paths = [file_path] + [level_path(file_path, factor) for factor in self.pyramid_factors]
+            total_bytes += sum(path.stat().st_size for path in paths if path.exists())
+            if i == 0:
+                continue
+
+            too_old = (self.retention_max_age is not None
+                       and now - datetime.fromisoformat(str(created_at)) > self.retention_max_age)
+            too_large = self.retention_max_bytes is not None and total_bytes > self.retention_max_bytes
+            if not (too_old or too_large):
+                continue
+
+            for path in paths:
+                path.unlink(missing_ok=True)
+            c.execute("UPDATE netcdf_files SET removed = TRUE WHERE filename = ?", (filename,))
             self.logger.info(f"Deleted file {filename}")
         
         conn.commit()
         conn.close()
 
+    def get_archived_files(self, last_n: Optional[int] = None) -> List[Path]:
+        """Return the archived forecast files, most recent first."""
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        c.execute("SELECT filename FROM netcdf_files WHERE removed = FALSE ORDER BY created_at DESC")
+        files = [self.save_path / filename for filename, in c.fetchall()]
+        conn.close()
+        return files[:last_n]
+
+    def get_forecast_history(self, lat: float, lon: float, valid_time: datetime,
+                             last_n: Optional[int] = None) -> xr.Dataset:
+        """Get how the forecast for a cell and valid time changed over the last `last_n` runs.
+
+        Only the chunk holding the requested cell and valid time is read from each archived run.
+        """
+        history = []
+        for path in self.get_archived_files(last_n):
+            with xr.open_dataset(path) as ds:
+                if 'issue_time' not in ds.coords or valid_time not in ds.indexes['valid_time']:
+                    continue
+                point = ds.sel(lat=lat, lon=lon, method='nearest').sel(valid_time=valid_time)
+                history.append(point.load())
+
+        if not history:
+            return xr.Dataset()
+        return xr.concat(history, dim='issue_time').sortby('issue_time')
+
     def parse_filename(self, filename: str) -> Optional[Tuple[int, datetime, datetime]]:
         """Parse HARMONIE filename to extract metadata."""
         match = re.match(r"harm43_v1_ned_uwcw_meteo_(\d{3})_(\d{8})(\d{4})_(\d{5})_GB", filename)
@@ -92,21 +194,39 @@ class HarmonieFileHandler:
             return run_number, run_time, valid_time
         return None
 
+    def crop_slices(self, lat: np.ndarray, lon: np.ndarray) -> Tuple[slice, slice]:
+        """Get the index slices of the grid that fall inside the region of interest."""
+        if self.bounds is None:
+            return slice(None), slice(None)
+
+        (south, west), (north, east) = self.bounds
+        lat_idx = np.flatnonzero((lat >= south) & (lat <= north))
+        lon_idx = np.flatnonzero((lon >= west) & (lon <= east))
+        if len(lat_idx) == 0 or len(lon_idx) == 0:
+            raise ValueError(f"Bounds {self.bounds} do not overlap the HARMONIE grid")
+
+        return slice(lat_idx[0], lat_idx[-1] + 1), slice(lon_idx[0], lon_idx[-1] + 1)
+
     def grib2xr(self, file_path: Path) -> xr.Dataset:
-        """Convert GRIB file to xarray Dataset."""
+        """Convert GRIB file to xarray Dataset, cropped to the region of interest."""
         with pygrib.open(str(file_path)) as grbs:
             prec = grbs.select(indicatorOfParameter=181)[0]
             T = grbs.select(indicatorOfParameter=11)[0]
             lats, lons = T.latlons()
 
+            # All files share the same grid, so the crop is only computed once
+            if self._crop_slices is None:
+                self._crop_slices = self.crop_slices(lats[:, 0], lons[0, :])
+            lat_slice, lon_slice = self._crop_slices
+
             return xr.Dataset(
                 {
-                    'temp': (['lat', 'lon'], T.values - 273.15),
-                    'prec': (['lat', 'lon'], prec.values)
+                    'temp': (['lat', 'lon'], T.values[lat_slice, lon_slice] - 273.15),
+                    'prec': (['lat', 'lon'], prec.values[lat_slice, lon_slice])
                 },
                 coords={
-                    'lat': lats[:, 0],
-                    'lon': lons[0, :]
+                    'lat': lats[lat_slice, 0],
+                    'lon': lons[0, lon_slice]
                 }
             )
 
@@ -125,12 +245,14 @@ class HarmonieFileHandler:
     def load_folder(self, dir_path: Path, run_numbers: List[str], folder_index: int) -> xr.Dataset:
         """Load and process files from a folder."""
         datasets_run = []
+        # Past steps are only needed as the start of the accumulation windows
+        cutoff = datetime.now() - timedelta(hours=max(self.accumulation_windows, default=0))
         for number in tqdm(run_numbers, 'Ensemble numbers', position=1, leave=False):
 
             datasets_valid_time = []
             for file in dir_path.glob(f'harm43_v1_ned_uwcw_meteo_{number}_*GB'):
                 run_number, run_time, valid_time = self.parse_filename(file.name)
-                if valid_time < datetime.now():
+                if valid_time < cutoff:
                     continue
 
 
@@ -141,8 +263,9 @@ class HarmonieFileHandler:
                 
                 run_number_mod = run_number_mod + folder_index * 6
 
-                ds = self.grib2xr(file)            
+                ds = self.grib2xr(file)
                 ds = ds.expand_dims({'valid_time': [valid_time], 'run_number': [run_number_mod]})
+                ds = ds.assign_coords(run_time=('run_number', [np.datetime64(run_time, 'ns')]))
 
                 datasets_valid_time.append(ds)
 
@@ -152,6 +275,50 @@ class HarmonieFileHandler:
 
         return  xr.concat(datasets_run, dim='run_number')
     
+    def build_pyramid(self, ds: xr.Dataset) -> dict:
+        """Coarsen the per-member fields into lower resolution levels by block averaging.
+
+        Ensemble percentiles are recomputed per level, as a mean of percentiles is not a percentile.
+        """
+        members = ds[[name for name, var in ds.data_vars.items() if 'run_number' in var.dims]]
+        return {
+            factor: self.compute_accumulation_percentiles(
+                members.coarsen(lat=factor, lon=factor, boundary='trim').mean()
+            )
+            for factor in self.pyramid_factors
+            if factor <= min(ds.sizes['lat'], ds.sizes['lon'])
+        }
+
+    def compute_accumulations(self, ds: xr.Dataset) -> xr.Dataset:
+        """Compute precipitation totals over each accumulation window for the whole cube at once.
+
+        A window total is the cumulative precipitation at the valid time minus the cumulative
+        precipitation `window` hours earlier. Cumulative precipitation is zero at the run time of
+        a member, so windows that start before the run only count precipitation since the run.
+        """
+        prec = ds['prec']
+        valid_time = prec['valid_time']
+        for window in self.accumulation_windows:
+            start_time = valid_time - np.timedelta64(window, 'h')
+            start = prec.reindex(valid_time=start_time.values).assign_coords(valid_time=valid_time)
+            start = start.where(start_time > ds['run_time'], 0)
+            ds[f'prec_{window}h'] = (prec - start).astype(np.float32)
+        return ds
+
+    def compute_accumulation_percentiles(self, ds: xr.Dataset) -> xr.Dataset:
+        """Compute the ensemble percentiles of each accumulation window."""
+        for window in self.accumulation_windows:
+            name = f'prec_{window}h'
+            if name not in ds:
+                continue
+            ds[f'{name}_pct'] = (
+                ds[name].quantile(np.array(ACCUMULATION_PERCENTILES) / 100, dim='run_number', skipna=True)
+                .rename(quantile='percentile')
+                .assign_coords(percentile=list(ACCUMULATION_PERCENTILES))
+                .astype(np.float32)
+            )
+        return ds
+
     def compute_uncertainty(self, ds: xr.Dataset) -> xr.Dataset:
         """Compute uncertainty of the dataset."""
         return ds['temp'].max(dim=['run_number']) - ds['temp'].min(dim=['run_number'])
@@ -171,11 +338,18 @@ class HarmonieFileHandler:
         self.logger.info("Combining datasets into a single xarray Dataset")
         combined_ds = xr.concat(datasets, dim='run_number')
         
-        self.logger.info("Sorting dataset by run_number")
-        combined_ds = combined_ds.sortby('run_number', ascending=True)
+        self.logger.info("Sorting dataset by run_number and valid_time")
+        combined_ds = combined_ds.sortby(['run_number', 'valid_time'], ascending=True)
+
+        # The issue time of the combined ensemble is the most recent run it contains
+        combined_ds = combined_ds.assign_coords(issue_time=combined_ds['run_time'].max().values)
 
-        self.logger.info("Computing precipitation difference")
-        combined_ds['prec_diff'] = combined_ds['prec'].diff('valid_time')
+        self.logger.info(f"Computing precipitation accumulations over {self.accumulation_windows} hours")
+        combined_ds = self.compute_accumulations(combined_ds)
+
+        self.logger.info("Dropping past steps")
+        combined_ds = combined_ds.sel(valid_time=combined_ds['valid_time'] >= np.datetime64(datetime.now()))
+        combined_ds = self.compute_accumulation_percentiles(combined_ds)
         
         self.logger.info("Processed 6 folders into combined dataset")
         self.logger.info("Saving combined dataset to NetCDF format...")
@@ -184,6 +358,34 @@ class HarmonieFileHandler:
         return combined_ds
 
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="Process HARMONIE runs or query the forecast archive.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('process', help="Process the unpacked runs into a new forecast (default)")
+    history_parser = subparsers.add_parser('history', help="Show how the forecast for a cell changed over the archived runs")
+    history_parser.add_argument('--lat', type=float, required=True)
+    history_parser.add_argument('--lon', type=float, required=True)
+    history_parser.add_argument('--valid-time', type=datetime.fromisoformat, required=True, help="e.g. 2025-01-01T12:00")
+    history_parser.add_argument('--last-n', type=int, help="Only use the most recent runs")
+    history_parser.add_argument('--variables', nargs='+', default=['temp', 'prec'])
+    history_parser.add_argument('--output', type=Path, help="Write the history to a CSV file instead of printing it")
+    args = parser.parse_args()
+
     handler = HarmonieFileHandler()
-    ds = handler.process_all_folders()
\ No newline at end of file
+    if args.command == 'history':
+        history = handler.get_forecast_history(args.lat, args.lon, args.valid_time, args.last_n)
+        if not history.data_vars:
+            handler.logger.info("No archived runs contain the requested valid time")
+            return
+        df = history[args.variables].to_dataframe()[args.variables].unstack('run_number')
+        if args.output:
+            df.to_csv(args.output)
+        else:
+            print(df.to_string())
+    else:
+        handler.process_all_folders()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
\ No newline at end of file
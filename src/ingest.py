@@ -0,0 +1,160 @@
+from pathlib import Path
+from src.harmonie_file_handler import HarmonieFileHandler, ACCUMULATION_WINDOWS, PYRAMID_FACTORS
+from src.file_tracker import FileTracker
+from src.knmi_api import OpenDataAPI
+from src.region import parse_roi_bounds
+from src.logger_config import get_logger
+
+from contextlib import contextmanager
+from tqdm import tqdm
+from datetime import datetime, timedelta
+import tarfile
+import shutil
+import fcntl
+import os
+
+logger = get_logger(__name__)
+
+DATASET_NAME = "harmonie_arome_cy43_p2a"
+DATASET_VERSION = "1.0"
+
+# Lock file shared by every process that runs an ingest
+LOCK_PATH = Path('data') / 'ingest.lock'
+
+
+def create_api(api_key: str) -> OpenDataAPI:
+    """Create a KNMI Open Data API client for the HARMONIE dataset."""
+    return OpenDataAPI(api_token=api_key, dataset_name=DATASET_NAME, dataset_version=DATASET_VERSION)
+
+
+def create_handler() -> HarmonieFileHandler:
+    """Create a file handler configured from the environment."""
+    pyramid_factors = os.getenv("PYRAMID_FACTORS")
+    max_age_hours = os.getenv("ARCHIVE_MAX_AGE_HOURS", "24")
+    max_gb = os.getenv("ARCHIVE_MAX_GB")
+    windows = os.getenv("ACCUMULATION_WINDOWS")
+    return HarmonieFileHandler(
+        bounds=parse_roi_bounds(os.getenv("ROI_BOUNDS")),
+        pyramid_factors=(tuple(int(x) for x in pyramid_factors.split(',') if x)
+                         if pyramid_factors is not None else PYRAMID_FACTORS),
+        retention_max_age=timedelta(hours=float(max_age_hours)) if max_age_hours else None,
+        retention_max_bytes=int(float(max_gb) * 1024**3) if max_gb else None,
+        accumulation_windows=(tuple(int(x) for x in windows.split(',') if x)
+                              if windows else ACCUMULATION_WINDOWS),
+    )
+
+
+@contextmanager
+def ingest_lock():
+    """Hold an exclusive lock so ingests never overlap, also across processes."""
+    LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_PATH, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_ingest(api: OpenDataAPI, interactive: bool = False) -> bool:
+    """
+    Download, unpack and process the latest HARMONIE runs.
+
+    Args:
+        api: KNMI Open Data API client
+        interactive: Ask for confirmation before downloading new files
+
+    Returns:
+        True if a new forecast was processed
+    """
+    # Ask before taking the lock, so a pending prompt never blocks other ingests
+    if interactive and not confirm_ingest(api):
+        logger.info("Keeping old files")
+        return False
+
+    with ingest_lock():
+        tracker = FileTracker()
+        try:
+            return _run_ingest(api, tracker)
+        finally:
+            tracker.close_session()
+
+
+def list_latest_files(api: OpenDataAPI) -> list:
+    """List the 6 most recently created files."""
+    logger.info(f"Fetching latest file of {DATASET_NAME} version {DATASET_VERSION}")
+
+    # sort the files in descending order and only retrieve the 6 most recent files
+    params = {"maxKeys": 6, "orderBy": "created", "sorting": "desc"}
+
+    response = api.list_files(params)
+    if "error" in response:
+        raise RuntimeError(f"Unable to retrieve list of files: {response['error']}")
+    return response["files"]
+
+
+def confirm_ingest(api: OpenDataAPI) -> bool:
+    """Ask whether new files should be downloaded, True if there are none to ask about."""
+    tracker = FileTracker()
+    try:
+        list_of_files = [file["filename"] for file in list_latest_files(api)]
+        files_to_download = tracker.filter_not_downloaded(list_of_files)
+    finally:
+        tracker.close_session()
+    if len(files_to_download) == 0:
+        return True
+
+    inp = input(f"Found {len(files_to_download)} new files. Do you want to download and update forecast? (Y/N)")
+    return inp.lower() == 'y'
+
+
+def _run_ingest(api: OpenDataAPI, tracker: FileTracker) -> bool:
+    files = list_latest_files(api)
+    for file in files:
+        filename = file.get("filename")
+        last_modified_str = file.get("lastModified")
+        last_modified_dt = datetime.strptime(last_modified_str, "%Y-%m-%dT%H:%M:%S%z")
+        tracker.add_file_to_track(filename, last_modified_dt)
+
+
+    list_of_files = [file["filename"] for file in files]
+    files_to_download = tracker.filter_not_downloaded(list_of_files)
+    if len(files_to_download) == 0:
+        logger.info("No new files to download")
+        return False
+
+    for file_name in tqdm(files_to_download, desc="Downloading files"):
+        response = api.get_file_url(file_name)
+        file_path = api.download_file_from_temporary_download_url(response["temporaryDownloadUrl"], file_name)
+        tracker.mark_file_as_downloaded(file_name, str(file_path))
+    logger.info(f"Downloaded {len(files_to_download)} files")
+
+    files_to_unpack = tracker.filter_not_unpacked(list_of_files)
+    for file_name in tqdm(files_to_unpack, desc="Unpacking files"):
+        if file_name.endswith(".tar"):
+            path =  Path('data') / file_name
+            unapacked_folder = path.with_suffix('')
+            unapacked_folder.mkdir(parents=True, exist_ok=False)
+            with tarfile.open(path) as tar:
+                tar.extractall(path=unapacked_folder, filter="data")
+
+            tracker.mark_file_as_unpacked(file_name, str(unapacked_folder))
+            path.unlink()
+    logger.info(f"Unpacked {len(files_to_download)} files")
+
+
+    # Retrieve older files and delete them
+    older_files = tracker.get_older_available_files()
+    for file in older_files:
+        path = Path(str(file.unpacked_location))
+
+        if path.exists():
+            shutil.rmtree(path)
+
+        tracker.mark_file_as_removed(file.filename)
+
+    logger.info(f"Deleted {len(older_files)} files")
+
+    handler = create_handler()
+    handler.process_all_folders()
+    return True
@@ -0,0 +1,21 @@
+from typing import Optional, Tuple
+
+Bounds = Tuple[Tuple[float, float], Tuple[float, float]]
+
+# Region of interest as ((south, west), (north, east)), matching the dashboard's maxBounds
+NL_BOUNDS: Bounds = ((50.75, 3.2), (53.7, 7.22))
+
+
+def parse_bounds(value: str) -> Bounds:
+    """Parse a bounding box given as "south,west,north,east"."""
+    south, west, north, east = (float(x) for x in value.split(','))
+    return (south, west), (north, east)
+
+
+def parse_roi_bounds(value: Optional[str]) -> Optional[Bounds]:
+    """Parse the ROI_BOUNDS setting, unset means NL_BOUNDS and empty or "none" disables cropping."""
+    if value is None:
+        return NL_BOUNDS
+    if value.strip().lower() in ('', 'none'):
+        return None
+    return parse_bounds(value)
@@ -0,0 +1,277 @@
+"""Long-running scheduler that ingests new HARMONIE runs as soon as they are published.
+
+Runs separately from the dashboard: `python -m src.scheduler`. New files are signalled by a
+pluggable NotificationSource, either the KNMI MQTT notification service or polling of the
+Open Data API as a fallback. The dashboard picks up each processed forecast by itself.
+"""
+import json
+import os
+import sys
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+from src.ingest import DATASET_NAME, DATASET_VERSION, create_api, run_ingest
+from src.knmi_api import OpenDataAPI
+from src.logger_config import get_logger, setup_logging
+
+logger = get_logger(__name__)
+
+# Called with the filename of the newly published file, if known
+NotifyCallback = Callable[[Optional[str]], None]
+
+
+class NotificationSource(ABC):
+    """Signals the scheduler when new files are published."""
+
+    @abstractmethod
+    def start(self, notify: NotifyCallback) -> None:
+        """Start calling `notify` for new files, raise OSError if the source is unreachable.
+
+        Sources also call `notify` once after starting, so files published while the
+        scheduler was not running are picked up as well.
+        """
+
+    @abstractmethod
+    def stop(self) -> None:
+        """Stop listening for new files."""
+
+
+class PollingSource(NotificationSource):
+    """Poll the Open Data API for the most recently created file."""
+
+    def __init__(self, api: OpenDataAPI, interval: float = 300):
+        self.api = api
+        self.interval = interval
+        self.last_filename = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, notify: NotifyCallback) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._poll, args=(notify,), name='polling-source', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _poll(self, notify: NotifyCallback) -> None:
+        # Only list the newest file, so a poll without news is a single small request
+        params = {"maxKeys": 1, "orderBy": "created", "sorting": "desc"}
+        while not self._stopped.is_set():
+            try:
+                response = self.api.list_files(params)
+                files = response.get("files", [])
+                if "error" in response:
+                    logger.error(f"Unable to retrieve list of files: {response['error']}")
+                elif files and files[0]["filename"] != self.last_filename:
+                    self.last_filename = files[0]["filename"]
+                    notify(self.last_filename)
+            except Exception as e:
+                logger.error(f"Error polling for new files: {e}")
+            self._stopped.wait(self.interval)
+
+
+def parse_notification(payload: bytes) -> Optional[str]:
+    """Filename of the file created notification, None if the payload is not one."""
+    try:
+        filename = json.loads(payload).get("data", {}).get("filename")
+    except (ValueError, AttributeError):
+        return None
+    return filename if isinstance(filename, str) else None
+
+
+class MqttSource(NotificationSource):
+    """Subscribe to file created notifications on an MQTT broker.
+
+    Defaults to the KNMI notification service, but any broker can be used, e.g. a local
+    mosquitto for testing. If the broker refuses a later reconnect, e.g. because the token
+    expired, the client is stopped and the fallback source takes over.
+    """
+
+    def __init__(self, host: str = "mqtt.dataplatform.knmi.nl", port: int = 443,
+                 token: Optional[str] = None, topic: Optional[str] = None,
+                 tls: bool = True, transport: str = "websockets",
+                 fallback: Optional[NotificationSource] = None, connect_timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.topic = topic or f"dataplatform/file/v1/{DATASET_NAME}/{DATASET_VERSION}/created"
+        self.tls = tls
+        self.transport = transport
+        self.fallback = fallback
+        self.connect_timeout = connect_timeout
+        self._client = None
+        self._listening = False
+        self._fallback_started = False
+
+    def start(self, notify: NotifyCallback) -> None:
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"chaocast-{uuid.uuid4()}",
+                             transport=self.transport)
+        if self.token:
+            client.username_pw_set("token", self.token)
+        if self.tls:
+            client.tls_set()
+
+        connack = []
+        connected = threading.Event()
+
+        def on_connect(client, userdata, flags, reason_code, properties):
+            if not connected.is_set():
+                connack.append(reason_code)
+                connected.set()
+            if reason_code.is_failure:
+                logger.error(f"Unable to connect to MQTT broker: {reason_code}")
+                # A refused first connect is raised by start, only later ones fall back
+                if self._listening:
+                    self._fall_back(notify)
+                return
+            logger.info(f"Subscribing to {self.topic} on {self.host}")
+            client.subscribe(self.topic, qos=1)
+            # Files published while disconnected were missed, so check for them
+            notify(None)
+
+        def on_message(client, userdata, message):
+            notify(parse_notification(message.payload))
+
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(self.host, self.port)
+        self._client = client
+        client.loop_start()
+
+        if not connected.wait(self.connect_timeout):
+            self._stop_client()
+            raise ConnectionError(f"No response from MQTT broker {self.host}:{self.port}")
+        if connack[0].is_failure:
+            self._stop_client()
+            raise ConnectionError(f"MQTT broker {self.host}:{self.port} refused connection: {connack[0]}")
+        self._listening = True
+
+    def stop(self) -> None:
+        self._listening = False
+        self._stop_client()
+        if self._fallback_started:
+            self.fallback.stop()
+            self._fallback_started = False
+
+    def _stop_client(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            client.disconnect()
+            client.loop_stop()
+
+    def _fall_back(self, notify: NotifyCallback) -> None:
+        self._listening = False
+        self._stop_client()
+        if self.fallback is None:
+            logger.error("Stopped listening for MQTT notifications, no fallback source configured")
+            return
+        logger.info(f"Falling back to {type(self.fallback).__name__}")
+        self.fallback.start(notify)
+        self._fallback_started = True
+
+
+class IngestScheduler:
+    """Run an ingest whenever the source signals a new file, never more than one at a time.
+
+    Notifications that arrive during an ingest are coalesced into a single follow-up ingest.
+    """
+
+    def __init__(self, source: NotificationSource, ingest: Callable[[], bool]):
+        self.source = source
+        self.ingest = ingest
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._worker = None
+
+    def notify(self, filename: Optional[str] = None) -> None:
+        logger.info(f"New file published: {filename}")
+        self._pending.set()
+
+    def start(self) -> None:
+        # Start the source first, so the worker is not left running if it is unreachable
+        self.source.start(self.notify)
+        self._stopped.clear()
+        self._worker = threading.Thread(target=self._run, name='ingest-worker', daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        self.source.stop()
+        self._stopped.set()
+        self._pending.set()
+        if self._worker is not None:
+            self._worker.join()
+
+    def _run(self) -> None:
+        while True:
+            self._pending.wait()
+            if self._stopped.is_set():
+                return
+            self._pending.clear()
+            try:
+                if self.ingest():
+                    logger.info("Finished ingesting new forecast")
+            except Exception as e:
+                logger.error(f"Error during ingest: {e}")
+
+
+def create_source(api: OpenDataAPI) -> NotificationSource:
+    """Create the notification source configured by SCHEDULER_SOURCE (mqtt or poll)."""
+    source = os.getenv("SCHEDULER_SOURCE", "mqtt" if os.getenv("NOTIFICATION_API_KEY") else "poll")
+    if source == "mqtt":
+        return MqttSource(
+            host=os.getenv("MQTT_HOST", "mqtt.dataplatform.knmi.nl"),
+            port=int(os.getenv("MQTT_PORT", "443")),
+            token=os.getenv("NOTIFICATION_API_KEY"),
+            topic=os.getenv("MQTT_TOPIC"),
+            tls=os.getenv("MQTT_TLS", "1") == "1",
+            transport=os.getenv("MQTT_TRANSPORT", "websockets"),
+            fallback=create_polling_source(api),
+        )
+    if source == "poll":
+        return create_polling_source(api)
+    raise ValueError(f"Unknown scheduler source {source}")
+
+
+def create_polling_source(api: OpenDataAPI) -> PollingSource:
+    """Create a polling source with the interval configured by POLL_INTERVAL."""
+    return PollingSource(api, interval=float(os.getenv("POLL_INTERVAL", "300")))
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    api_key = os.getenv("API_KEY")
+    if api_key is None:
+        logger.error("API_KEY environment variable not set.")
+        sys.exit(1)
+
+    api = create_api(api_key)
+    source = create_source(api)
+    scheduler = IngestScheduler(source, lambda: run_ingest(api))
+    try:
+        scheduler.start()
+    except OSError as e:
+        if isinstance(source, PollingSource):
+            raise
+        logger.error(f"Unable to start {type(source).__name__}: {e}, falling back to polling")
+        scheduler = IngestScheduler(create_polling_source(api), lambda: run_ingest(api))
+        scheduler.start()
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        logger.info("Stopping scheduler")
+        scheduler.stop()
+
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
@@ -0,0 +1,84 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import xarray as xr
+
+from src.export import _cell_blocks, iter_export_bytes, parse_points
+
+
+def make_dataset(n_lat=5, n_lon=4, n_time=3, n_run=2):
+    shape = (n_time, n_run, n_lat, n_lon)
+    valid_time = pd.date_range('2025-01-01 01:00', periods=n_time, freq='h')
+    return xr.Dataset(
+        {
+            'temp': (['valid_time', 'run_number', 'lat', 'lon'], np.arange(np.prod(shape), dtype=np.float32).reshape(shape)),
+            'prec': (['valid_time', 'run_number', 'lat', 'lon'], np.ones(shape, dtype=np.float32)),
+            'prec_1h_pct': (['percentile', 'valid_time', 'lat', 'lon'], np.zeros((5, n_time, n_lat, n_lon), dtype=np.float32)),
+        },
+        coords={
+            'valid_time': valid_time,
+            'run_number': np.arange(n_run),
+            'lat': np.linspace(51, 52, n_lat),
+            'lon': np.linspace(4, 5, n_lon),
+            'percentile': [5, 25, 50, 75, 95],
+            'issue_time': np.datetime64('2025-01-01 00:00', 'ns'),
+        }
+    )
+
+
+def test_export_streams_parquet():
+    ds = make_dataset()
+    data = b''.join(iter_export_bytes(ds, 'parquet', cells_per_batch=8))
+    table = pq.read_table(io.BytesIO(data))
+
+    assert table.num_rows == 5 * 4 * 3 * 2
+    assert table.column_names == ['lat', 'lon', 'valid_time', 'lead_time', 'run_number', 'temp', 'prec']
+    assert sorted(table['temp'].to_numpy()) == sorted(ds['temp'].values.ravel())
+    assert set(table['lead_time'].to_numpy()) == {1, 2, 3}
+
+
+def test_export_streams_arrow():
+    ds = make_dataset()
+    data = b''.join(iter_export_bytes(ds, 'arrow', variables=['temp'], points=[(51.0, 4.0)]))
+    table = pa.ipc.open_stream(data).read_all()
+
+    df = table.to_pandas()
+    expected = ds['temp'].isel(lat=0, lon=0).transpose('valid_time', 'run_number').values.ravel()
+    assert len(df) == 3 * 2
+    np.testing.assert_array_equal(df['temp'].to_numpy(), expected)
+
+
+def test_export_rejects_fields_without_members():
+    with pytest.raises(ValueError):
+        next(iter_export_bytes(make_dataset(), 'arrow', variables=['prec_1h_pct']))
+
+
+def test_parse_points_rejects_malformed_location():
+    assert parse_points('52,5;51.5,4.5') == [(52.0, 5.0), (51.5, 4.5)]
+    with pytest.raises(ValueError):
+        parse_points('52')
+
+
+def block_bounds(blocks):
+    return [(b['lat'].start, b['lat'].stop, b['lon'].start, b['lon'].stop) for b in blocks]
+
+
+def test_cell_blocks_align_to_chunks():
+    ds = make_dataset(n_lat=10)
+    blocks = list(_cell_blocks(ds, ((51.1, 4), (52, 5)), None, cells_per_batch=40, chunks=(4, 2)))
+
+    assert block_bounds(blocks) == [(1, 8, 0, 4), (8, 10, 0, 4)]
+
+
+def test_cell_blocks_split_bands_over_budget():
+    ds = make_dataset(n_lat=10)
+    blocks = list(_cell_blocks(ds, ((51.1, 4), (52, 5)), None, cells_per_batch=8, chunks=(4, 2)))
+
+    assert block_bounds(blocks) == [
+        (1, 4, 0, 2), (1, 4, 2, 4), (4, 8, 0, 2), (4, 8, 2, 4), (8, 10, 0, 2), (8, 10, 2, 4)
+    ]
+    assert all((b - a) * (d - c) <= 8 for a, b, c, d in block_bounds(blocks))
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from src.harmonie_file_handler import HarmonieFileHandler
+
+
+def make_run(issue_time, offset, n_time=6, n_run=3, n_lat=4, n_lon=4):
+    shape = (n_time, n_run, n_lat, n_lon)
+    valid_time = pd.date_range(issue_time + timedelta(hours=1), periods=n_time, freq='h')
+    return xr.Dataset(
+        {
+            'temp': (['valid_time', 'run_number', 'lat', 'lon'], np.full(shape, offset, dtype=np.float32)),
+            'prec': (['valid_time', 'run_number', 'lat', 'lon'], np.zeros(shape, dtype=np.float32)),
+        },
+        coords={
+            'valid_time': valid_time,
+            'run_number': np.arange(n_run),
+            'lat': np.linspace(51, 52, n_lat),
+            'lon': np.linspace(4, 5, n_lon),
+            'issue_time': np.datetime64(issue_time, 'ns'),
+        }
+    )
+
+
+def test_forecast_history_across_runs(tmp_path):
+    handler = HarmonieFileHandler(save_path=tmp_path, pyramid_factors=())
+    first = datetime(2025, 1, 1, 0, 0)
+    second = datetime(2025, 1, 1, 3, 0)
+    handler.save_dataset(make_run(first, offset=10.0))
+    handler.save_dataset(make_run(second, offset=20.0))
+
+    # Valid in both runs
+    history = handler.get_forecast_history(51.5, 4.5, datetime(2025, 1, 1, 5, 0))
+    assert list(history['issue_time'].values) == [np.datetime64(first, 'ns'), np.datetime64(second, 'ns')]
+    np.testing.assert_array_equal(history['temp'].values, [[10.0] * 3, [20.0] * 3])
+
+    # Only valid in the second run
+    history = handler.get_forecast_history(51.5, 4.5, datetime(2025, 1, 1, 8, 0))
+    assert list(history['issue_time'].values) == [np.datetime64(second, 'ns')]
+
+    # Limited to the most recent run
+    history = handler.get_forecast_history(51.5, 4.5, datetime(2025, 1, 1, 5, 0), last_n=1)
+    assert list(history['issue_time'].values) == [np.datetime64(second, 'ns')]
+
+
+def test_archive_chunks_per_valid_time(tmp_path):
+    handler = HarmonieFileHandler(save_path=tmp_path, pyramid_factors=())
+    encoding = handler.archive_encoding(make_run(datetime(2025, 1, 1), offset=0.0))
+
+    assert encoding['temp']['chunksizes'] == (1, 3, 4, 4)
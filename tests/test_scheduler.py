@@ -0,0 +1,132 @@
+import json
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+
+from src.scheduler import IngestScheduler, MqttSource, NotificationSource, PollingSource, parse_notification
+
+
+class FakeSource(NotificationSource):
+    def __init__(self):
+        self.notify = None
+        self.stopped = False
+
+    def start(self, notify):
+        self.notify = notify
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeAPI:
+    """Returns the given filenames as the newest file, repeating the last one."""
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.calls = 0
+
+    def list_files(self, params):
+        filename = self.filenames[min(self.calls, len(self.filenames) - 1)]
+        self.calls += 1
+        return {"files": [{"filename": filename}]}
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+def test_scheduler_coalesces_notifications_without_overlap():
+    release = threading.Event()
+    running = []
+    ingests = []
+
+    def ingest():
+        running.append(1)
+        assert len(running) == 1
+        ingests.append(1)
+        release.wait()
+        running.pop()
+        return True
+
+    source = FakeSource()
+    scheduler = IngestScheduler(source, ingest)
+    scheduler.start()
+    source.notify("first")
+    wait_until(lambda: len(ingests) == 1)
+
+    # Everything published during the ingest results in a single follow-up ingest
+    for i in range(10):
+        source.notify(f"file-{i}")
+    release.set()
+    wait_until(lambda: len(ingests) == 2)
+    time.sleep(0.1)
+    scheduler.stop()
+
+    assert len(ingests) == 2
+    assert source.stopped
+
+
+def test_polling_source_notifies_on_new_file():
+    api = FakeAPI(["run-00", "run-00", "run-00", "run-01"])
+    notified = []
+    source = PollingSource(api, interval=0.01)
+    source.start(notified.append)
+    wait_until(lambda: api.calls > 5)
+    source.stop()
+
+    assert notified == ["run-00", "run-01"]
+
+
+def test_parse_notification():
+    payload = json.dumps({"data": {"filename": "HARM43_V1_P2A_2025010100.tar"}}).encode()
+
+    assert parse_notification(payload) == "HARM43_V1_P2A_2025010100.tar"
+    assert parse_notification(b'{"data": {}}') is None
+    assert parse_notification(b'[1, 2]') is None
+    assert parse_notification(b'not json') is None
+
+
+def test_mqtt_source_raises_when_broker_unreachable():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    source = MqttSource(host="127.0.0.1", port=port, tls=False, transport="tcp")
+
+    with pytest.raises(OSError):
+        source.start(lambda filename: None)
+
+
+def local_broker_available():
+    try:
+        socket.create_connection(("127.0.0.1", 1883), timeout=0.5).close()
+        return True
+    except OSError:
+        return False
+
+
+@pytest.mark.skipif(not local_broker_available(), reason="No MQTT broker on localhost:1883")
+def test_mqtt_source_receives_notifications():
+    import paho.mqtt.publish as publish
+
+    topic = f"test/{uuid.uuid4()}/created"
+    notified = []
+    source = MqttSource(host="127.0.0.1", port=1883, topic=topic, tls=False, transport="tcp")
+    source.start(notified.append)
+    try:
+        # Every (re)connect triggers a catch-up
+        wait_until(lambda: notified == [None])
+        time.sleep(0.2)
+        publish.single(topic, json.dumps({"data": {"filename": "run-00.tar"}}), qos=1,
+                       hostname="127.0.0.1", port=1883)
+        wait_until(lambda: len(notified) == 2)
+    finally:
+        source.stop()
+
+    assert notified == [None, "run-00.tar"]